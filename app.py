@@ -1,10 +1,19 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
+import orjson
 import time
+import random
 import io
 import re
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import closing
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from datetime import timedelta
 
 # --- Constantes e Configuração Inicial ---
@@ -12,7 +21,33 @@ BRASIL_API_URL = "https://brasilapi.com.br/api/cep/v2/{}"
 VIACEP_API_URL = "https://viacep.com.br/ws/{}/json/"
 MAX_WORKERS = 20  # Limite sensato para não sobrecarregar as APIs
 REQUEST_TIMEOUT = 10  # Segundos para timeout das requisições
+PRIMARY_TIMEOUT = 3  # Timeout curto na BrasilAPI: se demorar, o CEP segue logo para o fallback
+HEDGE_DELAY = 1.0  # Segundos de vantagem da BrasilAPI antes de disparar o ViaCEP em paralelo
 MAX_RETRIES = 2 # Tentativas para cada API antes de falhar
+RETRY_BACKOFF = 0.5  # Segundos da primeira pausa entre tentativas (dobra a cada nova tentativa)
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}  # Respostas que valem uma nova tentativa
+PRIMARY_FAILURE_THRESHOLD = 20  # Vezes seguidas que o ViaCEP cobre a BrasilAPI antes de pulá-la
+PRIMARY_COOLDOWN = 60  # Segundos consultando só o ViaCEP depois disso
+MIN_IN_FLIGHT = 2  # Piso da janela de CEPs simultâneos quando as APIs estão limitando as requisições
+QUEUE_DEPTH = MAX_WORKERS  # Tarefas extras na fila do pool, só com a janela toda aberta, para nenhum worker ficar ocioso
+THROTTLE_STATUS_CODES = {429, 503}  # Respostas que indicam que a API está pedindo menos carga
+PROGRESS_INTERVAL = 0.25  # Segundos mínimos entre atualizações do painel de progresso
+CEP_CACHE_TTL = 86400  # Segundos que um CEP consultado com sucesso fica em cache
+CEP_CACHE_MAX_ENTRIES = 100_000  # CEPs mantidos em memória, somando todos os usuários; o resto fica no disco
+CEP_CACHE_DB = Path(__file__).parent / "cep_cache.db"  # Arquivo SQLite do cache persistente de CEPs, ao lado do app
+CEP_CACHE_DB_MAX_AGE = 86400 * 30  # CEPs em disco valem por 30 dias
+CEP_CACHE_DB_STALE_MAX_AGE = 86400 * 365  # Idade máxima de um CEP servido do disco quando as APIs falham
+SQLITE_MAX_PARAMS = 500  # CEPs por consulta "IN (...)" ao cache em disco
+UPLOAD_CACHE_MAX_ENTRIES = 8  # Planilhas lidas mantidas em memória, somando todos os usuários
+UPLOAD_CACHE_TTL = 3600  # Segundos até uma planilha lida sair do cache
+RESULT_FIELDS = ['endereco', 'bairro', 'cidade', 'estado', 'status']  # Chaves devolvidas por get_cep_data
+RESULT_COLUMNS = ['ENDEREÇO', 'BAIRRO', 'CIDADE', 'ESTADO', 'STATUS']  # Colunas adicionadas ao resultado
+
+# APIs consultadas: (nome, URL, timeout, mapa campo do resultado -> campo da resposta)
+PRIMARY_API = ('BrasilAPI', BRASIL_API_URL, PRIMARY_TIMEOUT,
+               {'endereco': 'street', 'bairro': 'neighborhood', 'cidade': 'city', 'estado': 'state'})
+FALLBACK_API = ('ViaCEP', VIACEP_API_URL, REQUEST_TIMEOUT,
+                {'endereco': 'logradouro', 'bairro': 'bairro', 'cidade': 'localidade', 'estado': 'uf'})
 
 # --- Configuração da Página Streamlit ---
 st.set_page_config(
@@ -25,115 +60,487 @@ st.set_page_config(
 
 def find_columns(df_columns):
     """Identifica inteligentemente as colunas de PROPOSTA e CEP."""
-    proposta_col = None
-    cep_col = None
-    for col in df_columns:
-        if re.search("proposta", col, re.IGNORECASE):
-            proposta_col = col
-        if re.search("cep", col, re.IGNORECASE):
-            cep_col = col
+    # Varre de trás para frente: em caso de empate, vale a última coluna encontrada
+    folded_columns = [(col, str(col).casefold()) for col in reversed(df_columns)]
+    proposta_col = next((col for col, name in folded_columns if "proposta" in name), None)
+    cep_col = next((col for col, name in folded_columns if "cep" in name), None)
     return proposta_col, cep_col
 
-def get_cep_data(cep, session):
+@st.cache_resource(ttl=CEP_CACHE_TTL)
+def get_cep_cache():
     """
-    Busca dados de um CEP com estratégia Primary/Fallback e retentativas.
-    Essa função é o coração da resiliência.
+    Cache de CEPs já resolvidos, compartilhado entre jobs, usuários e reruns.
+    CEPs quase nunca mudam, então o cache inteiro é descartado uma vez por dia.
+    Guarda no máximo CEP_CACHE_MAX_ENTRIES CEPs, descartando os usados há mais tempo.
     """
-    clean_cep = re.sub(r'\D', '', str(cep))
-    if len(clean_cep) != 8:
-        return {'status': 'CEP Inválido'}
+    return {'lock': threading.Lock(), 'entries': OrderedDict()}
 
-    # 1. Tentar BrasilAPI (Primary) com retentativas
+def cache_get(cep_cache, cep):
+    """Busca um CEP no cache em memória, marcando-o como usado agora."""
+    with cep_cache['lock']:
+        result = cep_cache['entries'].get(cep)
+        if result is not None:
+            cep_cache['entries'].move_to_end(cep)
+        return result
+
+def cache_put(cep_cache, results_by_cep):
+    """Guarda CEPs no cache em memória; acima do limite, saem os usados há mais tempo."""
+    with cep_cache['lock']:
+        entries = cep_cache['entries']
+        for cep, result in results_by_cep.items():
+            entries[cep] = result
+            entries.move_to_end(cep)
+        while len(entries) > CEP_CACHE_MAX_ENTRIES:
+            entries.popitem(last=False)
+
+def open_cep_cache_db():
+    """
+    Abre o cache persistente de CEPs (SQLite), criando a tabela na primeira vez.
+    Erros do SQLite sobem como sqlite3.Error; quem chama segue sem o cache.
+    """
+    conn = sqlite3.connect(CEP_CACHE_DB)
+    try:
+        # WAL: leituras de outros jobs não esperam a gravação; NORMAL evita um fsync por commit
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS cep_cache ("
+            "cep TEXT PRIMARY KEY, endereco TEXT, bairro TEXT, cidade TEXT, estado TEXT, "
+            "status TEXT, fetched_at INTEGER NOT NULL)"
+        )
+    except sqlite3.Error:
+        conn.close()
+        raise
+    return conn
+
+def load_cached_ceps(conn, ceps, max_age=CEP_CACHE_DB_MAX_AGE):
+    """Busca no cache em disco os CEPs com até `max_age` segundos, com poucas consultas em lote."""
+    cutoff = int(time.time()) - max_age
+    found = {}
+    for start in range(0, len(ceps), SQLITE_MAX_PARAMS):
+        chunk = ceps[start:start + SQLITE_MAX_PARAMS]
+        rows = conn.execute(
+            "SELECT cep, endereco, bairro, cidade, estado, status FROM cep_cache "
+            f"WHERE fetched_at > ? AND cep IN ({','.join('?' * len(chunk))})",
+            [cutoff, *chunk],
+        )
+        for cep, *fields in rows:
+            found[cep] = dict(zip(RESULT_FIELDS, fields))
+    return found
+
+def save_cached_ceps(conn, results_by_cep):
+    """Grava no cache em disco, numa única transação, os CEPs consultados com sucesso."""
+    now = int(time.time())
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO cep_cache "
+            "(cep, endereco, bairro, cidade, estado, status, fetched_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(cep, *(result.get(field) for field in RESULT_FIELDS), now) for cep, result in results_by_cep.items()],
+        )
+
+def only_digits(value):
+    """Mantém só os dígitos; CEPs que já vêm limpos (o caso comum) passam direto, sem regex."""
+    return value if value.isdecimal() else ''.join(filter(str.isdecimal, value))
+
+def is_valid_cep(clean_cep):
+    """CEP consultável: 8 dígitos ASCII e não zerado. Os demais nem vão à rede."""
+    return len(clean_cep) == 8 and clean_cep.isascii() and clean_cep != '00000000'
+
+def normalize_cep(value):
+    """
+    Deixa só os dígitos do CEP. Célula numérica do Excel perde o zero à
+    esquerda (01310-100 vira 1310100), então 7 dígitos recebem o zero de volta.
+    """
+    digits = only_digits(value)
+    return '0' + digits if len(digits) == 7 else digits
+
+def normalize_ceps(ceps):
+    """Limpa os CEPs de uma coluna, numa única passada."""
+    return ceps.astype(str).map(normalize_cep)
+
+def get_cep_data(clean_cep, session, cep_cache, request_executor, primary_circuit):
+    """
+    Busca dados de um CEP (já normalizado e com 8 dígitos) com estratégia
+    Primary/Fallback e retentativas. Essa função é o coração da resiliência.
+    """
+    cached = cache_get(cep_cache, clean_cep)
+    if cached is not None:
+        return cached
+
+    result = fetch_cep_data(clean_cep, session, request_executor, primary_circuit)
+    if result['status'].startswith('OK'):
+        cache_put(cep_cache, {clean_cep: result})
+    return result
+
+def fetch_json(session, url, timeout=REQUEST_TIMEOUT):
+    """
+    GET com retentativas e backoff exponencial com jitter. Só repete falhas
+    transitórias (rede, timeout, 429 e 5xx); respostas como 404 são definitivas.
+    As tentativas e pausas têm um orçamento de `timeout * MAX_RETRIES`: nenhuma
+    nova tentativa começa depois dele, e o timeout de cada uma é reduzido ao que
+    resta. O timeout do requests vale por conexão/leitura, não pela resposta
+    inteira, então um corpo que chega aos poucos ainda pode passar do orçamento.
+    Retorna o JSON decodificado, ou None se a API não respondeu com sucesso.
+    """
+    deadline = time.monotonic() + timeout * MAX_RETRIES
     for attempt in range(MAX_RETRIES):
+        if attempt:
+            pause = RETRY_BACKOFF * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+            if time.monotonic() + pause >= deadline:
+                return None # Sem tempo para outra tentativa
+            time.sleep(pause) # Pausa antes de retentativa
+        # Medido depois da pausa: o sleep pode passar do pedido, e o requests
+        # rejeita (ValueError) um timeout zero ou negativo
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
         try:
-            response = session.get(BRASIL_API_URL.format(clean_cep), timeout=REQUEST_TIMEOUT)
-            if response.status_code == 200:
-                data = response.json()
-                return {
-                    'endereco': data.get('street'),
-                    'bairro': data.get('neighborhood'),
-                    'cidade': data.get('city'),
-                    'estado': data.get('state'),
-                    'status': 'OK - BrasilAPI'
-                }
+            response = session.get(url, timeout=min(timeout, remaining))
         except requests.exceptions.RequestException:
-            time.sleep(0.5) # Pausa antes de retentativa
             continue
-    
-    # 2. Tentar ViaCEP (Fallback) com retentativas
-    for attempt in range(MAX_RETRIES):
-        try:
-            response = session.get(VIACEP_API_URL.format(clean_cep), timeout=REQUEST_TIMEOUT)
-            if response.status_code == 200:
-                data = response.json()
-                if not data.get('erro'):
-                    return {
-                        'endereco': data.get('logradouro'),
-                        'bairro': data.get('bairro'),
-                        'cidade': data.get('localidade'),
-                        'estado': data.get('uf'),
-                        'status': 'OK - ViaCEP'
-                    }
-        except requests.exceptions.RequestException:
-            time.sleep(0.5) # Pausa antes de retentativa
+        if response.status_code == 200:
+            try:
+                return orjson.loads(response.content)
+            except orjson.JSONDecodeError:
+                continue
+        if response.status_code not in RETRYABLE_STATUS_CODES:
+            return None
+    return None
+
+def query_api(session, api, clean_cep):
+    """
+    Consulta uma das APIs e converte a resposta para o formato do resultado
+    usando o mapa de campos da API. Retorna None se a API não encontrou o CEP.
+    """
+    name, url, timeout, field_map = api
+    data = fetch_json(session, url.format(clean_cep), timeout)
+    if data is None or data.get('erro'): # O ViaCEP responde 200 com {"erro": true} para CEP inexistente
+        return None
+    result = {field: data.get(key) for field, key in field_map.items()}
+    result['status'] = f'OK - {name}'
+    return result
+
+def record_primary_outcome(primary_circuit, succeeded):
+    """
+    Conta as vezes seguidas em que a BrasilAPI falhou e o ViaCEP respondeu.
+    Ao chegar em PRIMARY_FAILURE_THRESHOLD, abre o circuito: por PRIMARY_COOLDOWN
+    segundos os CEPs vão direto ao ViaCEP, sem gastar tentativas numa API fora do ar.
+    """
+    with primary_circuit['lock']:
+        if succeeded:
+            primary_circuit['failures'] = 0
+            return
+        primary_circuit['failures'] += 1
+        if primary_circuit['failures'] >= PRIMARY_FAILURE_THRESHOLD:
+            primary_circuit['failures'] = 0
+            primary_circuit['open_until'] = time.monotonic() + PRIMARY_COOLDOWN
+
+def record_primary_future(primary_circuit, primary):
+    """
+    Registra no circuit breaker o desfecho de uma BrasilAPI que perdeu o hedge
+    para o ViaCEP. Se ela foi cancelada ainda na fila, ou parou num erro
+    inesperado (um bug, não a API fora do ar), não há o que registrar.
+    """
+    if not primary.cancelled() and primary.exception() is None:
+        record_primary_outcome(primary_circuit, primary.result() is not None)
+
+def fetch_cep_data(clean_cep, session, request_executor, primary_circuit):
+    """
+    Consulta as APIs para um CEP já normalizado (8 dígitos). A BrasilAPI sai na
+    frente; se não responder em HEDGE_DELAY, o ViaCEP é disparado em paralelo e
+    vale a primeira resposta válida, para que uma BrasilAPI lenta não segure o CEP.
+    """
+    # 0. Circuito aberto: a BrasilAPI vem falhando, o ViaCEP assume e ela fica por último
+    if time.monotonic() < primary_circuit['open_until']:
+        result = query_api(session, FALLBACK_API, clean_cep) or query_api(session, PRIMARY_API, clean_cep)
+        return result or {'status': 'Falha na Consulta'}
+
+    # 1. Tentar BrasilAPI (Primary) com retentativas
+    primary = request_executor.submit(query_api, session, PRIMARY_API, clean_cep)
+    wait([primary], timeout=HEDGE_DELAY)
+
+    if primary.done():
+        error = primary.exception()
+        if error is None and primary.result() is not None:
+            record_primary_outcome(primary_circuit, True)
+            return primary.result()
+        # 2. BrasilAPI falhou: Tentar ViaCEP (Fallback) com retentativas
+        result = query_api(session, FALLBACK_API, clean_cep)
+        if result is None:
+            if error is not None:
+                raise error # Sem resposta do ViaCEP, o erro da BrasilAPI sobe como antes
+            return {'status': 'Falha na Consulta'} # Nenhuma achou: provável CEP inexistente, não culpa a BrasilAPI
+        if error is None: # Um erro inesperado é bug, não a BrasilAPI fora do ar
+            record_primary_outcome(primary_circuit, False)
+        return result
+
+    # 2. BrasilAPI ainda sem resposta: ViaCEP corre em paralelo (hedge)
+    fallback = request_executor.submit(query_api, session, FALLBACK_API, clean_cep)
+    errors = []
+    for future in as_completed([primary, fallback]):
+        if future.exception() is not None:
+            errors.append(future.exception()) # Guardado: a outra pode ainda responder
             continue
-    
+        result = future.result()
+        if result is not None:
+            # A perdedora é cancelada se ainda estiver na fila do pool; se já
+            # estiver na rede, termina sozinha e sua resposta é descartada
+            (fallback if future is primary else primary).cancel()
+            if future is primary:
+                record_primary_outcome(primary_circuit, True)
+            else:
+                # O ViaCEP achou o CEP: o desfecho da BrasilAPI conta quando ela
+                # terminar. Só ter sido lenta não é falha; dar timeout ou não achar, sim
+                primary.add_done_callback(lambda future: record_primary_future(primary_circuit, future))
+            return result
+
+    if errors:
+        raise errors[0] # Nenhuma respondeu: o erro sobe e o CEP sai como "Erro: ..."
     return {'status': 'Falha na Consulta'}
 
 
+@st.cache_resource
+def get_executor():
+    """
+    Pool de threads único para todo o servidor, criado uma vez e reaproveitado
+    entre jobs e reruns. Também limita o total de consultas simultâneas às APIs.
+    """
+    return ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="cep-worker")
+
+@st.cache_resource
+def get_request_executor():
+    """
+    Pool das requisições HTTP individuais. Cada worker de CEP dispara aqui a
+    BrasilAPI e, se ela demorar, o ViaCEP; por isso tem o dobro de threads.
+    """
+    return ThreadPoolExecutor(max_workers=MAX_WORKERS * 2, thread_name_prefix="cep-request")
+
+@st.cache_resource
+def get_primary_circuit():
+    """Estado do circuit breaker da BrasilAPI, compartilhado por todos os jobs do servidor."""
+    return {'lock': threading.Lock(), 'failures': 0, 'open_until': 0.0}
+
+@st.cache_resource
+def get_throttle_signals():
+    """Contador, para todo o servidor, das respostas em que as APIs pediram menos carga."""
+    return {'lock': threading.Lock(), 'count': 0}
+
+def count_throttle_response(throttle_signals, response):
+    """Hook de resposta da sessão HTTP: conta os 429/503 vistos em qualquer consulta."""
+    if response.status_code in THROTTLE_STATUS_CODES:
+        with throttle_signals['lock']:
+            throttle_signals['count'] += 1
+
+@st.cache_resource
+def get_http_session():
+    """
+    Sessão HTTP única para todo o servidor: as conexões keep-alive com as APIs
+    sobrevivem de um job para o outro. O pool comporta todas as threads que fazem
+    requisições: as do pool de requisições e as dos workers, que chamam o ViaCEP
+    direto no fallback sequencial. O padrão do requests guarda só 10 conexões por
+    host; com mais threads que isso, as excedentes são descartadas e cada nova
+    consulta paga um novo handshake TCP+TLS.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=MAX_WORKERS * 3)
+    session.mount("https://", adapter)
+    throttle_signals = get_throttle_signals()
+    session.hooks['response'].append(lambda response, *args, **kwargs: count_throttle_response(throttle_signals, response))
+    return session
+
 def process_job(job_df, cep_col, ui_placeholders):
     """
     Processa um único job (DataFrame) usando ThreadPoolExecutor.
     Atualiza os placeholders da UI em tempo real.
     """
-    total_records = len(job_df)
-    results = [None] * total_records
+    # Cada CEP distinto é consultado uma única vez; `row_codes` liga cada linha
+    # do job ao seu CEP distinto para remontar o resultado completo no final.
+    row_codes, unique_ceps = pd.factorize(normalize_ceps(job_df[cep_col]))
+    # CEPs fora do formato já saem resolvidos aqui, sem ocupar o pool de threads
+    results = [None if is_valid_cep(cep) else {'status': 'CEP Inválido'} for cep in unique_ceps]
+    valid_ceps = [(index, cep) for index, cep in enumerate(unique_ceps) if results[index] is None]
+
+    # CEPs já em cache (memória ou disco) não passam pelo pool
+    cep_cache = get_cep_cache()
+    for index, cep in valid_ceps:
+        results[index] = cache_get(cep_cache, cep)
+    # Antes de ir à rede, traz do disco os CEPs que a memória ainda não conhece
+    cold_ceps = [cep for index, cep in valid_ceps if results[index] is None]
+    try:
+        with closing(open_cep_cache_db()) as cache_db:
+            disk_hits = load_cached_ceps(cache_db, cold_ceps)
+    except sqlite3.Error:
+        disk_hits = {} # Cache em disco indisponível (arquivo, lock, disco cheio): segue só com a memória e a rede
+    cache_put(cep_cache, disk_hits)
+    for index, cep in valid_ceps:
+        if results[index] is None:
+            results[index] = disk_hits.get(cep)
+    ceps_to_fetch = [(index, cep) for index, cep in valid_ceps if results[index] is None]
+    total_records = len(ceps_to_fetch)
     records_processed = 0
-    start_time = time.time()
+    start_time = time.perf_counter()
+    last_ui_update = start_time
 
-    with requests.Session() as session:
-        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            future_to_index = {
-                executor.submit(get_cep_data, row[cep_col], session): index
-                for index, row in job_df.iterrows()
-            }
+    session = get_http_session()
+    executor = get_executor()
+    request_executor = get_request_executor()
+    primary_circuit = get_primary_circuit()
+    throttle_signals = get_throttle_signals()
+    # Produtor/consumidor: no máximo `in_flight_limit` CEPs ficam no pool (mais
+    # QUEUE_DEPTH na fila quando a janela está toda aberta),
+    # e cada conclusão libera espaço para o próximo CEP do job.
+    pending_rows = iter(ceps_to_fetch)
+    future_to_index = {}
+
+    def submit_next():
+        for index, cep in pending_rows:
+            future_to_index[executor.submit(get_cep_data, cep, session, cep_cache, request_executor, primary_circuit)] = index
+            return True
+        return False
 
-            for future in as_completed(future_to_index):
-                index = future_to_index[future]
-                try:
-                    results[index] = future.result()
-                except Exception as e:
-                    results[index] = {'status': f'Erro: {e}'}
-                
-                records_processed += 1
-                
-                # --- Atualização do Painel de Controle (Feedback em Tempo Real) ---
-                if records_processed % 10 == 0 or records_processed == total_records: # Atualiza a cada 10 registros
-                    elapsed_time = time.time() - start_time
-                    speed = records_processed / elapsed_time if elapsed_time > 0 else 0
-                    etc_seconds = (total_records - records_processed) / speed if speed > 0 else 0
-                    
-                    progress = records_processed / total_records
-                    
-                    with ui_placeholders["progress_bar"]:
-                        st.progress(progress, text=f"Processando... {records_processed}/{total_records}")
-                    
-                    with ui_placeholders["metrics"]:
-                        etc_str = str(timedelta(seconds=int(etc_seconds)))
-                        st.metric(label="Velocidade Atual", value=f"{speed:.1f} reg/s")
-
-                    with ui_placeholders["etc"]:
-                        st.metric(label="Tempo Estimado de Conclusão", value=f"{etc_str}")
-
-    return pd.DataFrame(results)
+    def iter_completed():
+        # Janela adaptativa (AIMD) de CEPs consultados ao mesmo tempo, limitada
+        # às MAX_WORKERS threads do pool. Ao fim de cada janela de conclusões,
+        # cresce um CEP se ela passou sem 429/503 e cai pela metade se houve
+        # algum. A janela logo depois de um corte é de carência: 429/503 nela
+        # vêm de respostas já em trânsito, então ela não cresce nem corta.
+        # Cada CEP pode ter até duas requisições no ar (o hedge do ViaCEP roda no
+        # pool de requisições), então as requisições HTTP ficam em até 2x a janela.
+        in_flight_limit = MAX_WORKERS
+        completed_in_window = in_flight_limit
+        throttled_in_window = False
+        grace_window = False
+        seen_throttles = throttle_signals['count']
+        while True:
+            queue_depth = QUEUE_DEPTH if in_flight_limit == MAX_WORKERS else 0
+            while len(future_to_index) < in_flight_limit + queue_depth and submit_next():
+                pass
+            if not future_to_index:
+                return
+            done, _ = wait(future_to_index, return_when=FIRST_COMPLETED)
+            completed_in_window += len(done)
+            throttles = throttle_signals['count']
+            if throttles != seen_throttles:
+                seen_throttles = throttles
+                throttled_in_window = True
+            if completed_in_window >= in_flight_limit:
+                if not throttled_in_window:
+                    in_flight_limit = min(MAX_WORKERS, in_flight_limit + 1)
+                    grace_window = False
+                elif not grace_window:
+                    in_flight_limit = max(MIN_IN_FLIGHT, in_flight_limit // 2)
+                    grace_window = True
+                else:
+                    grace_window = False
+                completed_in_window = 0
+                throttled_in_window = False
+            yield from done
+
+    for future in iter_completed():
+        index = future_to_index.pop(future)
+        try:
+            results[index] = future.result()
+        except Exception as e:
+            results[index] = {'status': f'Erro: {e}'}
+        
+        records_processed += 1
+        
+        # --- Atualização do Painel de Controle (Feedback em Tempo Real) ---
+        now = time.perf_counter()
+        if now - last_ui_update >= PROGRESS_INTERVAL or records_processed == total_records: # Atualiza no máximo a cada PROGRESS_INTERVAL
+            last_ui_update = now
+            elapsed_time = now - start_time
+            speed = records_processed / elapsed_time if elapsed_time > 0 else 0
+            etc_seconds = (total_records - records_processed) / speed if speed > 0 else 0
+            
+            progress = records_processed / total_records
+            
+            with ui_placeholders["progress_bar"]:
+                st.progress(progress, text=f"Processando... {records_processed}/{total_records}")
+            
+            with ui_placeholders["metrics"]:
+                etc_str = str(timedelta(seconds=int(etc_seconds)))
+                st.metric(label="Velocidade Atual", value=f"{speed:.1f} reg/s")
+
+            with ui_placeholders["etc"]:
+                st.metric(label="Tempo Estimado de Conclusão", value=f"{etc_str}")
+
+    fetched_ceps = set(cold_ceps).difference(disk_hits)
+    fetched = {
+        cep: result for cep, result in zip(unique_ceps, results)
+        if cep in fetched_ceps and result['status'].startswith('OK')
+    }
+    # Se as APIs falharam, serve o último resultado conhecido do disco, mesmo
+    # vencido: dados de CEP quase não mudam. Nunca volta a ser gravado como novo.
+    failed = [
+        (index, cep) for index, cep in ceps_to_fetch
+        if results[index]['status'] == 'Falha na Consulta'
+    ]
+    # O cache em disco é opcional: se falhar, o job termina com o que já tem
+    if fetched:
+        try:
+            with closing(open_cep_cache_db()) as cache_db:
+                save_cached_ceps(cache_db, fetched)
+        except sqlite3.Error:
+            pass
+    if failed:
+        try:
+            with closing(open_cep_cache_db()) as cache_db:
+                stale_hits = load_cached_ceps(cache_db, [cep for _, cep in failed], CEP_CACHE_DB_STALE_MAX_AGE)
+        except sqlite3.Error:
+            stale_hits = {}
+        for index, cep in failed:
+            if cep in stale_hits:
+                stale = stale_hits[cep]
+                results[index] = {**stale, 'status': f"{stale['status']} (cache desatualizado)"}
+
+    # Esquema fixo: cada coluna é montada uma vez por CEP distinto e depois
+    # expandida para todas as linhas do job pelos códigos, sem um dict por linha
+    return pd.DataFrame({
+        field: np.array([result.get(field) for result in results], dtype=object)[row_codes]
+        for field in RESULT_FIELDS
+    }, index=job_df.index)
+
+@st.cache_data(show_spinner=False, max_entries=UPLOAD_CACHE_MAX_ENTRIES, ttl=UPLOAD_CACHE_TTL)
+def load_spreadsheet(file_bytes):
+    """
+    Lê a planilha enviada. O Streamlit reexecuta o script a cada interação e o
+    arquivo continua no uploader; o cache (pelo conteúdo) evita reler o Excel.
+    Tudo é lido como texto: uma coluna de CEP numérica com uma célula vazia
+    viraria float64, e "1310100.0" se tornaria outro CEP depois de limpo.
+    """
+    return pd.read_excel(io.BytesIO(file_bytes), dtype=str)
 
 def to_excel(df):
     """Converte um DataFrame para um objeto BytesIO em formato Excel."""
     output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
+    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
         df.to_excel(writer, index=False, sheet_name='Resultados')
     return output.getvalue()
 
+def to_csv(df):
+    """Converte um DataFrame para CSV (separador ';', com BOM para o Excel abrir acentos corretamente)."""
+    return df.to_csv(index=False, sep=';').encode('utf-8-sig')
+
+def to_parquet(df):
+    """
+    Converte um DataFrame para Parquet (zstd). Colunas de texto da planilha
+    podem misturar números e strings, o que o Arrow rejeita; elas vão como texto.
+    """
+    text_columns = df.select_dtypes(include='object').columns
+    output = io.BytesIO()
+    df.astype(dict.fromkeys(text_columns, 'string')).rename(columns=str).to_parquet(
+        output, index=False, compression='zstd'
+    )
+    return output.getvalue()
+
+# Formatos de exportação: função de conversão e MIME type de cada um
+EXPORT_FORMATS = {
+    'xlsx': (to_excel, "application/vnd.ms-excel"),
+    'csv': (to_csv, "text/csv"),
+    'parquet': (to_parquet, "application/octet-stream"),
+}
+
 # --- Gerenciamento de Estado da Aplicação (O segredo para a UI não congelar) ---
 if 'jobs_queue' not in st.session_state:
     st.session_state.jobs_queue = []
@@ -143,6 +550,8 @@ if 'is_processing' not in st.session_state:
     st.session_state.is_processing = False
 if 'job_counter' not in st.session_state:
     st.session_state.job_counter = 0
+if 'queued_uploads' not in st.session_state:
+    st.session_state.queued_uploads = set()
 
 # --- Interface do Usuário (UI) ---
 
@@ -158,28 +567,29 @@ uploaded_file = st.file_uploader(
     disabled=st.session_state.is_processing
 )
 
-if uploaded_file is not None:
+# O mesmo upload (file_id) continua no uploader em todos os reruns seguintes:
+# se já está na fila, nem é lido de novo, e a página não o duplica ao recarregar
+if uploaded_file is not None and uploaded_file.file_id not in st.session_state.queued_uploads:
     try:
-        df = pd.read_excel(uploaded_file)
+        df = load_spreadsheet(uploaded_file.getvalue())
         proposta_col, cep_col = find_columns(df.columns)
         
         if not proposta_col or not cep_col:
             st.error(f"Erro: Não foi possível encontrar as colunas 'PROPOSTA' e 'CEP' no arquivo. Colunas encontradas: {', '.join(df.columns)}")
         else:
+            # Adiciona na fila global
+            st.session_state.queued_uploads.add(uploaded_file.file_id)
             st.session_state.job_counter += 1
             job_id = f"Job #{st.session_state.job_counter} - {uploaded_file.name}"
-            
-            # Adiciona na fila global, mas evita duplicatas se a página recarregar
-            if not any(j['id'] == job_id for j in st.session_state.jobs_queue):
-                st.session_state.jobs_queue.append({
-                    "id": job_id,
-                    "df": df,
-                    "proposta_col": proposta_col,
-                    "cep_col": cep_col,
-                    "status": "Pendente",
-                    "original_df": df.copy() # Guarda o original
-                })
-                st.success(f"✅ Job '{job_id}' ({len(df)} registros) adicionado à fila.")
+            st.session_state.jobs_queue.append({
+                "id": job_id,
+                "df": df,
+                "proposta_col": proposta_col,
+                "cep_col": cep_col,
+                "status": "Pendente",
+                "original_df": df.copy() # Guarda o original
+            })
+            st.success(f"✅ Job '{job_id}' ({len(df)} registros) adicionado à fila.")
 
     except Exception as e:
         st.error(f"Ocorreu um erro ao ler o arquivo: {e}")
@@ -217,7 +627,7 @@ if st.session_state.jobs_queue and not st.session_state.is_processing:
         
         queue_copy = list(st.session_state.jobs_queue)
         for job in queue_copy:
-            job_start_time = time.time()
+            job_start_time = time.perf_counter()
             job['status'] = 'Processando'
             
             # Passa os placeholders para a função de processamento
@@ -233,21 +643,22 @@ if st.session_state.jobs_queue and not st.session_state.is_processing:
 
             # Enriquecer o DataFrame original
             final_df = job['original_df'].copy()
-            final_df[['ENDEREÇO', 'BAIRRO', 'CIDADE', 'ESTADO', 'STATUS']] = result_df
+            final_df[RESULT_COLUMNS] = result_df
 
             # Limpa os placeholders para o próximo job
             progress_bar_placeholder.empty()
             metrics_placeholder.empty()
             etc_placeholder.empty()
             
-            job_processing_time = time.time() - job_start_time
+            job_processing_time = time.perf_counter() - job_start_time
             
             # Move o job da fila para a lista de concluídos
             job_concluido = {
                 'id': job['id'],
                 'df_result': final_df,
                 'record_count': len(final_df),
-                'processing_time': job_processing_time
+                'processing_time': job_processing_time,
+                'exports': {} # Bytes por formato, gerados na primeira exportação e reaproveitados nos reruns
             }
             st.session_state.completed_jobs.insert(0, job_concluido) # Insere no início
             st.session_state.jobs_queue.pop(0)
@@ -270,15 +681,37 @@ st.divider()
 st.header("3. Jobs Concluídos")
 
 if st.session_state.completed_jobs:
-    for job in st.session_state.completed_jobs:
-        with st.expander(f"**{job['id']}** - {job['record_count']} registros processados em {job['processing_time']:.2f} segundos"):
-            st.dataframe(job['df_result'].head())
-            st.download_button(
-                label=f"⬇️ Exportar {job['id']}",
-                data=to_excel(job['df_result']),
-                file_name=f"resultado_{re.sub('[^a-zA-Z0-9]', '_', job['id'])}.xlsx",
-                mime="application/vnd.ms-excel",
-                key=f"download_{job['id']}" # Chave única para cada botão
-            )
+    # Uma única tabela de resumo em vez de um expander + botão por job
+    jobs_df = pd.DataFrame(
+        [(job['id'], job['record_count'], job['processing_time']) for job in st.session_state.completed_jobs],
+        columns=['Job', 'Registros', 'Tempo (s)']
+    )
+    st.dataframe(
+        jobs_df,
+        use_container_width=True,
+        hide_index=True,
+        column_config={"Tempo (s)": st.column_config.NumberColumn(format="%.2f")}
+    )
+
+    jobs_by_id = {job['id']: job for job in st.session_state.completed_jobs}
+    selected_id = st.selectbox("Selecione um job para visualizar e exportar:", list(jobs_by_id))
+    job = jobs_by_id[selected_id]
+    st.dataframe(job['df_result'].head())
+
+    # CSV e Parquet são bem mais rápidos de gerar que xlsx em jobs grandes; o
+    # padrão é CSV para que o xlsx só seja gerado quando o operador o escolher
+    export_format = st.radio(
+        "Formato de exportação:", list(EXPORT_FORMATS), index=list(EXPORT_FORMATS).index('csv'), horizontal=True
+    )
+    convert, mime = EXPORT_FORMATS[export_format]
+    if export_format not in job['exports']:
+        job['exports'][export_format] = convert(job['df_result'])
+    st.download_button(
+        label=f"⬇️ Exportar {job['id']}",
+        data=job['exports'][export_format],
+        file_name=f"resultado_{re.sub('[^a-zA-Z0-9]', '_', job['id'])}.{export_format}",
+        mime=mime,
+        key="download_job"
+    )
 else:
     st.info("Nenhum job foi concluído ainda.")
\ No newline at end of file